@@ -1,6 +1,7 @@
 # scripts/debug_spi_n4.py
 from __future__ import annotations
 import sys, pathlib, collections
+from functools import lru_cache
 
 # 确保能 import src
 PROJECT_ROOT = pathlib.Path(__file__).resolve().parents[1]
@@ -9,11 +10,22 @@ if str(PROJECT_ROOT) not in sys.path:
 
 from src.engine import ReachabilityEngine
 from src.model import Distribution, ProtocolState
+from src.protocols import permitted_calls
+
+@lru_cache(maxsize=None)
+def _sorted_group(g: int) -> tuple:
+    """位掩码 -> 组内升序的 secret 名元组（bit i -> 'A'+i）；每个不同的组只转换一次。"""
+    return tuple(chr(65 + i) for i in range(g.bit_length()) if g >> i & 1)
+
+def _raw_sort_key(t: tuple):
+    return (-len(t), t)
 
 # 与 tests 里的“无重标号”一致：组内升序 + 组间(大小降序, 组字典序)
+# secret_sets 为 Distribution.secrets（位掩码元组，可哈希），整体结果同样缓存
+@lru_cache(maxsize=None)
 def raw_key(secret_sets):
-    canon = [tuple(sorted(g)) for g in secret_sets]
-    canon.sort(key=lambda t: (-len(t), t))
+    canon = list(map(_sorted_group, secret_sets))
+    canon.sort(key=_raw_sort_key)
     return tuple(canon)
 
 def main():
@@ -26,7 +38,7 @@ def main():
     root = ProtocolState.initial(start, proto)
 
     from collections import deque
-    from src.canonical import canonical_key as std_canon
+    from src.canonical import canonical_key as std_canon, unpack_key
 
     seen_std = set([std_canon(start.secrets)])
     q = deque([root])
@@ -34,20 +46,25 @@ def main():
     bucket = collections.defaultdict(set)  # std_key -> set(raw_key)
     bucket[next(iter(seen_std))].add(raw_key(start.secrets))
 
+    # 热循环里用局部名（LOAD_FAST），避免每条边的全局/属性查找
+    local_permitted = permitted_calls
+    local_update = ProtocolState.update
+    popleft, push = q.popleft, q.append
+
     while q:
-        st = q.popleft()
-        for call in __import__("src.protocols", fromlist=[""]).permitted_calls(st, proto):
-            ns = st.update(call, proto)
+        st = popleft()
+        for call in local_permitted(st, proto):
+            ns = local_update(st, call, proto)
             k_std = std_canon(ns.distribution.secrets)
             k_raw = raw_key(ns.distribution.secrets)
             bucket[k_std].add(k_raw)
             if k_std not in seen_std:
                 seen_std.add(k_std)
-                q.append(ns)
+                push(ns)
 
     print(f"[debug] std_key count = {len(seen_std)}")
     # 找到最大“合并桶”
-    merged = [(k, len(v)) for k, v in bucket.items()]
+    merged = [(unpack_key(k, n), len(v)) for k, v in bucket.items()]
     merged.sort(key=lambda x: x[1], reverse=True)
     print(f"[debug] top merged sizes: {merged[:10]} (格式: (std_key, 合并raw_key数量))")
 
@@ -56,7 +73,7 @@ def main():
     if first_multi:
         k, raws = first_multi
         print("\n[debug] A merged bucket example:")
-        print("std_key =", k)
+        print("std_key =", unpack_key(k, n))
         print("raw_keys in this bucket (each is a distinct state under no-relabel):")
         for rk in sorted(raws):
             print("  ", rk)
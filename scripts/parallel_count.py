@@ -17,6 +17,7 @@ if str(PROJECT_ROOT) not in sys.path:
     sys.path.insert(0, str(PROJECT_ROOT))
 
 from src.engine import ReachabilityEngine
+from src.canonical import unpack_key
 
 
 def positive_int(val: str) -> int:
@@ -46,23 +47,59 @@ def _save_layer_sizes_npy(path: pathlib.Path, per_level: list[int]) -> bool:
         print(f"[warn] NumPy not available ({e}); skip NPY save.")
         return False
     _ensure_parent(path)
-    np.save(str(path), np.array(per_level, dtype=int))
+    # 计数放得进 int32 就用 int32：文件和读取带宽减半；不落 pickle
+    max_c = max(per_level, default=0)
+    dtype = np.int32 if max_c < 2**31 else np.int64
+    np.save(str(path), np.ascontiguousarray(per_level, dtype=dtype), allow_pickle=False)
     return True
 
 
-def _key_to_jsonable(k) -> list:
-    # k: Tuple[Tuple[int, ...], ...] -> List[List[int]]
-    return [list(inner) for inner in k]
+def _save_layers_npz(path: pathlib.Path, layers: dict[int, set], n: int) -> bool:
+    # 两列 depth(int32) / key(uint64)，压缩存储；key 超过 64 位（n*n > 64）时无法放进 uint64，跳过
+    try:
+        import numpy as np  # type: ignore
+    except Exception as e:
+        print(f"[warn] NumPy not available ({e}); skip NPZ save.")
+        return False
+    if n * n > 64:
+        print(f"[warn] Packed keys need {n * n} bits (> 64) for n={n}; skip NPZ save.")
+        return False
+    _ensure_parent(path)
+    depths = sorted(layers.keys())
+    sizes = [len(layers[d]) for d in depths]
+    depth_arr = np.repeat(np.asarray(depths, dtype=np.int32), sizes)
+    key_arr = np.fromiter(
+        (k for d in depths for k in layers[d]), dtype=np.uint64, count=sum(sizes)
+    )
+    np.savez_compressed(str(path), depth=depth_arr, key=key_arr)
+    return True
 
 
-def _save_layers_csv(path: pathlib.Path, layers: dict[int, set]) -> None:
+def _key_to_jsonable(k: int, n: int) -> list:
+    # k: 打包的 canonical key (int) -> List[List[int]]
+    return [list(inner) for inner in unpack_key(k, n)]
+
+
+def _compact_json_dumps():
+    """紧凑 JSON 序列化：优先 orjson（快约一个数量级），否则退回标准库 json。"""
+    try:
+        import orjson  # type: ignore
+        return lambda obj: orjson.dumps(obj).decode("utf-8")
+    except Exception:
+        return lambda obj: json.dumps(obj, separators=(",", ":"))
+
+
+def _save_layers_csv(path: pathlib.Path, layers: dict[int, set], n: int, json_keys: bool = False) -> None:
     _ensure_parent(path)
+    dumps = _compact_json_dumps() if json_keys else None
     with path.open("w", encoding="utf-8", newline="") as f:
         w = csv.writer(f)
-        w.writerow(["depth", "key"])  # key 为 JSON 字符串
+        w.writerow(["depth", "key"])  # key 默认为打包 int（unpack_key 还原）；--json-keys 时为 JSON 字符串
         for d in sorted(layers.keys()):
-            for k in layers[d]:
-                w.writerow([d, json.dumps(_key_to_jsonable(k), separators=(",", ":"))])
+            if dumps is None:
+                w.writerows((d, k) for k in layers[d])
+            else:
+                w.writerows((d, dumps(_key_to_jsonable(k, n))) for k in layers[d])
 
 
 def _save_meta_json(path: pathlib.Path, args: argparse.Namespace, res: dict, per_level: list[int]) -> None:
@@ -74,7 +111,8 @@ def _save_meta_json(path: pathlib.Path, args: argparse.Namespace, res: dict, per
             "n": args.n,
             "max_depth": args.depth,
             "workers": args.workers,
-            "batch_size": args.batch_size,
+            "batch_size": "auto" if args.auto_batch else args.batch_size,
+            "key_format": "json" if args.json_keys else "packed_int",
             "mode": "serial" if args.serial else "parallel",
         },
         "summary": {
@@ -113,21 +151,53 @@ def _save_per_level_parquet(path: pathlib.Path, per_level: list[int]) -> bool:
         return False
 
 
-def _save_layers_parquet(path: pathlib.Path, layers: dict[int, set]) -> bool:
-    pk = _try_import_pandas()
+def _try_import_pyarrow() -> tuple | None:
+    try:
+        import pyarrow as pa  # type: ignore
+        import pyarrow.parquet as pq  # type: ignore
+        return (pa, pq)
+    except Exception as e:
+        print(f"[warn] pyarrow not available ({e}); skip Parquet save.")
+        return None
+
+
+def _key_arrow_type(pa, n: int):
+    """
+    canonical key 列类型：key 为 n*n 位的打包 int。
+    n*n <= 63 时直接存 int64（可走字典/RLE 编码），否则存定长小端 binary。
+    """
+    if n * n <= 63:
+        return pa.int64()
+    return pa.binary((n * n + 7) // 8)
+
+
+def _key_arrow_array(pa, keys: list[int], n: int):
+    key_type = _key_arrow_type(pa, n)
+    if pa.types.is_integer(key_type):
+        return pa.array(keys, type=key_type)
+    nbytes = key_type.byte_width
+    return pa.array([k.to_bytes(nbytes, "little") for k in keys], type=key_type)
+
+
+def _save_layers_parquet(path: pathlib.Path, layers: dict[int, set], n: int) -> bool:
+    # 逐层写 RecordBatch：峰值内存只有一层，不再先攒整张 rows 表
+    pk = _try_import_pyarrow()
     if pk is None:
         return False
-    (pd,) = pk
+    pa, pq = pk
     _ensure_parent(path)
-    rows = []
-    for d in sorted(layers.keys()):
-        for k in layers[d]:
-            rows.append(
-                {"depth": d, "key_json": json.dumps(_key_to_jsonable(k), separators=(",", ":"))}
-            )
+    schema = pa.schema([("depth", pa.int32()), ("key", _key_arrow_type(pa, n))])
     try:
-        df = pd.DataFrame(rows, columns=["depth", "key_json"])
-        df.to_parquet(path, index=False)
+        with pq.ParquetWriter(str(path), schema) as writer:
+            for d in sorted(layers.keys()):
+                keys = list(layers[d])
+                if not keys:
+                    continue
+                batch = pa.RecordBatch.from_arrays(
+                    [pa.repeat(pa.scalar(d, pa.int32()), len(keys)), _key_arrow_array(pa, keys, n)],
+                    schema=schema,
+                )
+                writer.write_batch(batch)
         return True
     except Exception as e:
         print(f"[warn] Failed to save Parquet ({e}); skip.")
@@ -164,6 +234,11 @@ def main() -> None:
         default=128,
         help="States per task batch for parallel expansion",
     )
+    parser.add_argument(
+        "--auto-batch",
+        action="store_true",
+        help="Pick the batch size per BFS layer from the frontier size (overrides --batch-size)",
+    )
     parser.add_argument(
         "--verbose", action="store_true", help="Print per-level progress"
     )
@@ -184,19 +259,27 @@ def main() -> None:
     parser.add_argument(
         "--dump-layers",
         action="store_true",
-        help="Additionally save all canonical keys into a single CSV (may be large).",
+        help="Additionally save all canonical keys into a single CSV (may be large), "
+             "plus a compressed NPZ (depth/key arrays) when keys fit in uint64.",
+    )
+    parser.add_argument(
+        "--json-keys",
+        action="store_true",
+        help="Write layer keys in the CSV dump as JSON lists (legacy format; uses orjson if installed) "
+             "instead of packed ints.",
     )
     parser.add_argument(
         "--out-parquet",
         action="store_true",
-        help="Additionally save per-level and (optionally) layers to Parquet (requires pandas + pyarrow/fastparquet).",
+        help="Additionally save per-level and (optionally) layers to Parquet (requires pandas + pyarrow/fastparquet). "
+             "Layer keys are stored as packed ints (int64, or fixed-width little-endian binary when n*n > 63).",
     )
 
     args = parser.parse_args()
 
     print(
         f"Running {args.protocol}  n={args.n}  depth={args.depth}  "
-        f"workers={args.workers}  batch={args.batch_size}  "
+        f"workers={args.workers}  batch={'auto' if args.auto_batch else args.batch_size}  "
         f"mode={'serial' if args.serial else 'parallel'}"
     )
 
@@ -204,7 +287,7 @@ def main() -> None:
 
     t0 = time.perf_counter()
     if args.serial:
-        res = eng.bfs(args.n, max_depth=args.depth)
+        res = eng.bfs(args.n, max_depth=args.depth, keep_layers=args.dump_layers)
     else:
         # 需要 src/engine.py 中的 bfs_parallel(protocol, n, max_depth, workers, batch_size, verbose)
         res = eng.bfs_parallel(
@@ -213,6 +296,8 @@ def main() -> None:
             workers=args.workers,
             batch_size=args.batch_size,
             verbose=args.verbose,
+            keep_layers=args.dump_layers,
+            auto_batch=args.auto_batch,
         )
     t1 = time.perf_counter()
 
@@ -220,7 +305,8 @@ def main() -> None:
     print("transitions    :", res["transitions"])
 
     # 组装 per_level 数组（连续深度，从 0 到 max_depth 或最后一层）
-    depths = sorted(res["layers"].keys())
+    # 只依赖 layer_sizes：未 --dump-layers 时引擎不会保留各层 key
+    depths = sorted(res["layer_sizes"].keys())
     per_level = [res["layer_sizes"].get(d, 0) for d in range(depths[0], depths[-1] + 1)]
     print("per_level      :", per_level)
     print(f"elapsed        : {t1 - t0:.2f}s")
@@ -252,8 +338,11 @@ def main() -> None:
         # 选配：全部层 keys（CSV）
         if args.dump_layers:
             layers_csv = base.with_name(base.name + "_layers.csv")
-            _save_layers_csv(layers_csv, res["layers"])
+            _save_layers_csv(layers_csv, res["layers"], args.n, json_keys=args.json_keys)
             print(f"[saved] {layers_csv}")
+            layers_npz = base.with_name(base.name + "_layers.npz")
+            if _save_layers_npz(layers_npz, res["layers"], args.n):
+                print(f"[saved] {layers_npz}")
 
         # 选配：Parquet
         if args.out_parquet:
@@ -263,7 +352,7 @@ def main() -> None:
                 print(f"[saved] {per_level_parquet}")
             if args.dump_layers:
                 layers_parquet = base.with_name(base.name + "_layers.parquet")
-                ok2 = _save_layers_parquet(layers_parquet, res["layers"])
+                ok2 = _save_layers_parquet(layers_parquet, res["layers"], args.n)
                 if ok2:
                     print(f"[saved] {layers_parquet}")
 
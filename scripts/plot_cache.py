@@ -30,10 +30,15 @@ import argparse
 import json
 import sys
 import pathlib
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
 import pandas as pd
+import matplotlib
+
+matplotlib.use("Agg")  # batch rendering only; skip GUI backend probing
 import matplotlib.pyplot as plt
+from matplotlib.axes import Axes
+from matplotlib.figure import Figure
 
 
 # ---------------------- Paths & loading ----------------------
@@ -47,11 +52,33 @@ LONG_CSV = ART_DIR / "layers_long.csv"
 SUMMARY_CSV = ART_DIR / "summary.csv"
 
 
-def load_long() -> Optional[pd.DataFrame]:
-    """Load long-table (level-wise) data."""
+LONG_COLUMNS = ["protocol", "n", "mode", "level", "states"]
+
+
+def load_long(
+    protocol: Optional[str] = None,
+    n: Optional[int] = None,
+    mode: Optional[str] = None,
+) -> Optional[pd.DataFrame]:
+    """Load long-table (level-wise) data.
+
+    Only the columns the plots use are read. Any of protocol / n / mode that is
+    given is pushed down as a Parquet filter, so only matching row groups are read.
+    """
+    filters = [
+        (col, "=", val)
+        for col, val in (("protocol", protocol), ("n", n), ("mode", mode))
+        if val is not None
+    ]
+
     if LONG_PARQUET.exists():
         try:
-            df = pd.read_parquet(LONG_PARQUET)
+            df = pd.read_parquet(
+                LONG_PARQUET,
+                engine="pyarrow",
+                columns=LONG_COLUMNS,
+                filters=filters or None,
+            )
             print(f"[load] {LONG_PARQUET}")
             return df
         except Exception as e:
@@ -59,7 +86,9 @@ def load_long() -> Optional[pd.DataFrame]:
 
     if LONG_CSV.exists():
         try:
-            df = pd.read_csv(LONG_CSV)
+            df = pd.read_csv(LONG_CSV, usecols=LONG_COLUMNS)
+            for col, _, val in filters:
+                df = df[df[col] == val]
             print(f"[load] {LONG_CSV}")
             return df
         except Exception as e:
@@ -84,125 +113,160 @@ def load_summary() -> Optional[pd.DataFrame]:
 
 
 # ---------------------- Plot helpers ----------------------
-def savefig(path: pathlib.Path):
+def new_axes(fig: Optional[Figure], figsize: Tuple[float, float]) -> Tuple[Figure, Axes]:
+    """Clear and resize a reusable figure (or create one) and return it with a single Axes."""
+    if fig is None:
+        fig = Figure()
+    else:
+        fig.clf()
+    fig.set_size_inches(*figsize)
+    return fig, fig.add_subplot()
+
+
+def savefig(fig: Figure, path: pathlib.Path):
     path.parent.mkdir(parents=True, exist_ok=True)
-    plt.tight_layout()
-    plt.savefig(path, dpi=160)
-    plt.close()
+    fig.tight_layout()
+    fig.savefig(path, dpi=160)
     print(f"[ok] wrote {path}")
 
 
-def series_from_long(df: pd.DataFrame, protocol: str, n: int, mode: str) -> Optional[pd.DataFrame]:
-    """Return a tiny df with columns [level, states] sorted by level for (protocol, n, mode)."""
+def aggregate_long(df: Optional[pd.DataFrame]) -> Optional[pd.DataFrame]:
+    """Aggregate the long table once: states summed per (protocol, n, mode, level).
+
+    The result is indexed by a sorted (protocol, n, mode) MultiIndex so every
+    series_from_long call is an index lookup instead of a boolean mask + groupby.
+    """
     if df is None:
         return None
-    sel = df[(df["protocol"] == protocol) & (df["n"] == n) & (df["mode"] == mode)]
-    if sel.empty:
+    agg = (
+        df.groupby(["protocol", "n", "mode", "level"], observed=True, sort=True)["states"]
+        .sum()
+        .reset_index()
+    )
+    return agg.set_index(["protocol", "n", "mode"]).sort_index()
+
+
+def series_from_long(agg: Optional[pd.DataFrame], protocol: str, n: int, mode: str) -> Optional[pd.DataFrame]:
+    """Return a tiny df with columns [level, states] sorted by level for (protocol, n, mode).
+
+    `agg` is the output of aggregate_long (duplicates already summed per level).
+    """
+    if agg is None:
+        return None
+    try:
+        sel = agg.loc[[(protocol, n, mode)]]
+    except KeyError:
         return None
-    # In case of duplicates, aggregate by level
-    grp = sel.groupby("level", as_index=False)["states"].sum().sort_values("level")
-    return grp
+    return sel.reset_index(drop=True)[["level", "states"]]
 
 
 # ---------------------- Individual plots ----------------------
-def plot_any_n7(outdir: pathlib.Path, df_long: Optional[pd.DataFrame]):
+def plot_any_n7(outdir: pathlib.Path, agg: Optional[pd.DataFrame], fig: Optional[Figure] = None):
     """ANY n=7, serial vs parallel layer growth."""
-    if df_long is None:
+    if agg is None:
         print("[skip] any_n7: no long-table data")
         return
-    s = series_from_long(df_long, "ANY", 7, "serial")
-    p = series_from_long(df_long, "ANY", 7, "parallel")
+    s = series_from_long(agg, "ANY", 7, "serial")
+    p = series_from_long(agg, "ANY", 7, "parallel")
     if s is None or p is None:
         print("[skip] any_n7: need both serial and parallel for ANY n=7")
         return
 
-    plt.figure(figsize=(8, 4.5))
-    plt.plot(s["level"], s["states"], marker="o", label="serial")
-    plt.plot(p["level"], p["states"], marker="o", label="parallel")
-    plt.xlabel("Depth")
-    plt.ylabel("States per level")
-    plt.title("ANY n=7 — Level Growth (serial vs parallel)")
-    plt.legend()
-    savefig(outdir / "any_n7_serial_vs_parallel.png")
+    fig, ax = new_axes(fig, (8, 4.5))
+    ax.plot(s["level"], s["states"], marker="o", label="serial")
+    ax.plot(p["level"], p["states"], marker="o", label="parallel")
+    ax.set_xlabel("Depth")
+    ax.set_ylabel("States per level")
+    ax.set_title("ANY n=7 — Level Growth (serial vs parallel)")
+    ax.legend()
+    savefig(fig, outdir / "any_n7_serial_vs_parallel.png")
 
 
-def plot_n4_overlay(outdir: pathlib.Path, df_long: Optional[pd.DataFrame]):
+def plot_n4_overlay(outdir: pathlib.Path, agg: Optional[pd.DataFrame], fig: Optional[Figure] = None):
     """n=4 per-protocol overlay (serial): ANY/CO/LNS/TOK/SPI."""
-    if df_long is None:
+    if agg is None:
         print("[skip] n4_overlay: no long-table data")
         return
 
     protocols = ["ANY", "CO", "LNS", "TOK", "SPI"]
     found = 0
 
-    plt.figure(figsize=(8, 4.5))
+    fig, ax = new_axes(fig, (8, 4.5))
     for proto in protocols:
-        s = series_from_long(df_long, proto, 4, "serial")
+        s = series_from_long(agg, proto, 4, "serial")
         if s is None:
             continue
-        plt.plot(s["level"], s["states"], marker="o", label=proto)
+        ax.plot(s["level"], s["states"], marker="o", label=proto)
         found += 1
 
     if found < 2:
-        plt.close()
         print("[skip] n=4 overlay: fewer than 2 protocols available")
         return
 
-    plt.xlabel("Depth")
-    plt.ylabel("States per level")
-    plt.title("n=4 — Per-Protocol Layer Growth (serial)")
-    plt.legend()
-    savefig(outdir / "n4_per_protocol_serial.png")
+    ax.set_xlabel("Depth")
+    ax.set_ylabel("States per level")
+    ax.set_title("n=4 — Per-Protocol Layer Growth (serial)")
+    ax.legend()
+    savefig(fig, outdir / "n4_per_protocol_serial.png")
 
 
-def plot_co_n6_parallel(outdir: pathlib.Path, df_long: Optional[pd.DataFrame]):
+def plot_co_n6_parallel(outdir: pathlib.Path, agg: Optional[pd.DataFrame], fig: Optional[Figure] = None):
     """CO n=6 (parallel) layer growth."""
-    if df_long is None:
+    if agg is None:
         print("[skip] co_n6_parallel: no long-table data")
         return
-    s = series_from_long(df_long, "CO", 6, "parallel")
+    s = series_from_long(agg, "CO", 6, "parallel")
     if s is None:
         print("[skip] CO n=6 parallel: no matching rows")
         return
 
-    plt.figure(figsize=(8, 4.5))
-    plt.plot(s["level"], s["states"], marker="o", label="CO n=6 parallel")
-    plt.xlabel("Depth")
-    plt.ylabel("States per level")
-    plt.title("CO n=6 — Layer Growth (parallel)")
-    plt.legend()
-    savefig(outdir / "co_n6_parallel.png")
+    fig, ax = new_axes(fig, (8, 4.5))
+    ax.plot(s["level"], s["states"], marker="o", label="CO n=6 parallel")
+    ax.set_xlabel("Depth")
+    ax.set_ylabel("States per level")
+    ax.set_title("CO n=6 — Layer Growth (parallel)")
+    ax.legend()
+    savefig(fig, outdir / "co_n6_parallel.png")
 
 
-def plot_elapsed_bars(outdir: pathlib.Path, df_summary: Optional[pd.DataFrame]):
+def plot_elapsed_bars(outdir: pathlib.Path, df_summary: Optional[pd.DataFrame], fig: Optional[Figure] = None):
     """Bar chart of elapsed_sec for all runs in summary.csv (optional)."""
     if df_summary is None or df_summary.empty:
         print("[skip] elapsed_bars: no summary")
         return
 
-    # Make a compact label: proto-n-d-mode(-wX-bY)
-    def label_row(r):
-        base = f"{r['protocol']}-n{int(r['n'])}-d{int(r['depth'])}-{r['mode']}"
-        if r["mode"] == "parallel":
-            w = str(int(r["workers"])) if pd.notna(r["workers"]) else "?"
-            b = str(int(r["batch_size"])) if pd.notna(r["batch_size"]) else "?"
-            base += f"-w{w}-b{b}"
-        return base
+    # Make a compact label: proto-n-d-mode(-wX-bY), built with vectorized string ops
+    def int_str(col: pd.Series) -> pd.Series:
+        return col.astype("Int64").astype("string").fillna("?").astype(str)
 
     df = df_summary.copy()
-    df["label"] = df.apply(label_row, axis=1)
+    df["label"] = (
+        df["protocol"].astype(str)
+        + "-n" + df["n"].astype(int).astype(str)
+        + "-d" + df["depth"].astype(int).astype(str)
+        + "-" + df["mode"].astype(str)
+    )
+    par = df["mode"] == "parallel"
+    df.loc[par, "label"] += "-w" + int_str(df.loc[par, "workers"]) + "-b" + int_str(df.loc[par, "batch_size"])
     df = df.sort_values("elapsed_sec", ascending=True)
 
-    plt.figure(figsize=(10, 5))
-    plt.barh(range(len(df)), df["elapsed_sec"])
-    plt.yticks(range(len(df)), df["label"])
-    plt.xlabel("Elapsed seconds")
-    plt.title("Elapsed time per run")
-    plt.tight_layout()
-    savefig(outdir / "elapsed_bars.png")
+    fig, ax = new_axes(fig, (10, 5))
+    ax.barh(range(len(df)), df["elapsed_sec"])
+    ax.set_yticks(range(len(df)), df["label"])
+    ax.set_xlabel("Elapsed seconds")
+    ax.set_title("Elapsed time per run")
+    savefig(fig, outdir / "elapsed_bars.png")
 
 
 # ---------------------- CLI ----------------------
+# Slice of the long table each level-growth plot reads (passed to load_long as filters)
+LONG_FILTERS = {
+    "any_n7": {"protocol": "ANY", "n": 7},
+    "n4_overlay": {"n": 4, "mode": "serial"},
+    "co_n6": {"protocol": "CO", "n": 6, "mode": "parallel"},
+}
+
+
 def main():
     parser = argparse.ArgumentParser(description="Plot cached results from artifacts/*.")
     parser.add_argument(
@@ -221,23 +285,34 @@ def main():
     outdir = pathlib.Path(args.outdir)
     outdir.mkdir(parents=True, exist_ok=True)
 
-    df_long = load_long()
-    df_summary = load_summary()
-
     # Decide which plots to run
     to_run = args.plots or ["any_n7", "n4_overlay", "co_n6", "elapsed"]
 
+    # Push down only the filters shared by every selected long-table plot
+    long_plots = [LONG_FILTERS[name] for name in to_run if name in LONG_FILTERS]
+    if long_plots:
+        common = dict(set.intersection(*(set(f.items()) for f in long_plots)))
+        agg = aggregate_long(load_long(**common))
+    else:
+        agg = None
+    df_summary = load_summary() if "elapsed" in to_run else None
+
+    # One figure reused (cleared) across all plots instead of a fresh one per plot
+    fig = plt.figure()
+
     if "any_n7" in to_run:
-        plot_any_n7(outdir, df_long)
+        plot_any_n7(outdir, agg, fig)
 
     if "n4_overlay" in to_run:
-        plot_n4_overlay(outdir, df_long)
+        plot_n4_overlay(outdir, agg, fig)
 
     if "co_n6" in to_run:
-        plot_co_n6_parallel(outdir, df_long)
+        plot_co_n6_parallel(outdir, agg, fig)
 
     if "elapsed" in to_run:
-        plot_elapsed_bars(outdir, df_summary)
+        plot_elapsed_bars(outdir, df_summary, fig)
+
+    plt.close(fig)
 
 
 if __name__ == "__main__":
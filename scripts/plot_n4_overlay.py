@@ -2,6 +2,9 @@
 from __future__ import annotations
 import argparse, ast
 from pathlib import Path
+import matplotlib
+
+matplotlib.use("Agg")  # batch rendering only; skip GUI backend probing
 import matplotlib.pyplot as plt
 import pandas as pd
 
@@ -55,12 +58,20 @@ def _unify_long_schema(df: pd.DataFrame) -> pd.DataFrame:
     if not size_col:
         raise KeyError(f"Missing size/count/frontier column in {list(df.columns)}")
 
-    out = pd.DataFrame({
-        "protocol": df[proto_col].astype(str).str.upper(),
-        "n": pd.to_numeric(df[n_col], errors="coerce").astype("Int64"),
-        "layer": pd.to_numeric(df[layer_col], errors="coerce").astype("Int64"),
-        "size": pd.to_numeric(df[size_col], errors="coerce").astype("Int64"),
+    # one projection + rename instead of rebuilding the frame column by column
+    out = df[[proto_col, n_col, layer_col, size_col]].rename(columns={
+        proto_col: "protocol", n_col: "n", layer_col: "layer", size_col: "size",
     })
+    # protocol has only a handful of distinct values: upper-case the categories,
+    # not every row
+    out["protocol"] = out["protocol"].astype("category").map(lambda c: str(c).upper())
+    # numeric columns: coerce only the ones that are not numeric already,
+    # then a single astype to nullable Int64
+    num_cols = ["n", "layer", "size"]
+    for c in num_cols:
+        if not pd.api.types.is_numeric_dtype(out[c]):
+            out[c] = pd.to_numeric(out[c], errors="coerce")
+    out = out.astype({c: "Int64" for c in num_cols})
     # mode: from column or guessed
     out["mode"] = _guess_mode(df).astype(str)
     return out
@@ -146,24 +157,24 @@ def plot_n4_overlay(outdir: Path, n: int = 4, mode: str = "serial", prefer: str
     order = ["ANY","CO","LNS","TOK","SPI"]
     df["protocol"] = pd.Categorical(df["protocol"], categories=order, ordered=True)
 
-    plt.figure(figsize=(9, 4.5), dpi=160)
+    fig, ax = plt.subplots(figsize=(9, 4.5), dpi=160)
     for proto in order:
         d = df[df["protocol"] == proto].sort_values("layer")
         if d.empty:
             continue
-        plt.plot(d["layer"], d["size"], marker="o", linewidth=1.8, label=proto)
+        ax.plot(d["layer"], d["size"], marker="o", linewidth=1.8, label=proto)
 
-    plt.xlabel("BFS depth (layer)")
-    plt.ylabel("unique states at layer")
-    plt.title(f"n={n}, {mode} BFS — per-layer frontier sizes")
-    plt.grid(True, alpha=0.25, linewidth=0.6)
-    plt.legend(loc="best", ncol=3, frameon=False)
+    ax.set_xlabel("BFS depth (layer)")
+    ax.set_ylabel("unique states at layer")
+    ax.set_title(f"n={n}, {mode} BFS — per-layer frontier sizes")
+    ax.grid(True, alpha=0.25, linewidth=0.6)
+    ax.legend(loc="best", ncol=3, frameon=False)
 
     outdir.mkdir(parents=True, exist_ok=True)
     out_path = outdir / f"n{n}_per_protocol_{mode}.png"
-    plt.tight_layout()
-    plt.savefig(out_path)
-    plt.close()
+    fig.tight_layout()
+    fig.savefig(out_path)
+    plt.close(fig)
     return out_path
 
 # ---- cli ----
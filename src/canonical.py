@@ -1,8 +1,9 @@
 # src/canonical.py
 from __future__ import annotations
-from typing import Iterable, Any, List, Set, Tuple, Dict
+from functools import lru_cache
+from typing import Iterable, Any, List, Tuple
 
-__all__ = ["canonical_key"]
+__all__ = ["canonical_key", "canonical_key_cached", "unpack_key"]
 
 # ---------- helpers ----------
 def _to_int(x: Any) -> int:
@@ -13,45 +14,183 @@ def _to_int(x: Any) -> int:
         return ord(x) - 65
     raise TypeError(f"canonical_key expects int or 1-char str, got {type(x).__name__}")
 
-def _normalize_groups(secret_sets: Iterable[Iterable[Any]]) -> List[Set[int]]:
-    """把输入规范为 List[Set[int]]，内部统一为 int。"""
-    groups: List[Set[int]] = []
-    for S in secret_sets:
-        groups.append({_to_int(v) for v in S})
-    return groups
+@lru_cache(maxsize=None)
+def _bits(mask: int) -> Tuple[int, ...]:
+    """位掩码 -> 升序的位下标元组（即组内有序元组）；掩码取值有限，结果缓存复用。"""
+    out = []
+    while mask:
+        low = mask & -mask
+        out.append(low.bit_length() - 1)
+        mask ^= low
+    return tuple(out)
 
-def _relabel_compact(groups: List[Set[int]]) -> List[Tuple[int, ...]]:
+def _group_mask(S: Iterable[Any]) -> int:
+    m = 0
+    for v in S:
+        m |= 1 << _to_int(v)
+    return m
+
+@lru_cache(maxsize=None)
+def _frozen_mask(S: frozenset) -> int:
+    """frozenset 组的掩码缓存（Distribution.secrets 中的组会被反复传入）。"""
+    return _group_mask(S)
+
+def _normalize_groups(secret_sets: Iterable[Any]) -> List[int]:
+    """
+    把输入规范为 List[int]：每组一个位掩码（第 v 位表示含 secret v）。
+    组本身已是 int（Distribution.secrets 的位掩码形式）时原样使用。
+    """
+    return [S if isinstance(S, int) else
+            _frozen_mask(S) if isinstance(S, frozenset) else _group_mask(S)
+            for S in secret_sets]
+
+class _SortKeyTable(dict):
+    """
+    位宽 width 下 掩码 -> 排序键 的查表（缺项时现算），
+    把 (-组大小, 组内容字典序) 压成单个 int：
+      高位 width - 组大小：大组在前；
+      低位 按位反转后取反：同样大小的两组，较低的不同位属于谁，谁的组内元组字典序更小。
+    与元组版本排序结果一致；作为 sort 的 key=table.__getitem__ 时全程在 C 层查表、比较 int。
+    """
+    __slots__ = ("width",)
+
+    def __init__(self, width: int):
+        super().__init__()
+        self.width = width
+
+    def __missing__(self, mask: int) -> int:
+        width = self.width
+        rev = int(format(mask, f"0{width}b")[::-1], 2) if width else 0
+        key = self[mask] = ((width - mask.bit_count()) << width) | (((1 << width) - 1) ^ rev)
+        return key
+
+@lru_cache(maxsize=None)
+def _sort_key_table(width: int) -> _SortKeyTable:
+    return _SortKeyTable(width)
+
+def _relabel_compact(masks: List[int]) -> List[int]:
     """
     按给定顺序紧致重标号（首次出现即分配 0..k-1），
-    返回每个组的有序元组表示。
+    返回重标号后的位掩码列表。bit_map[v] 为旧位 v 的新位（1 << new）。
+    每组只遍历尚未分配的位；全部分配完即停止扫描。
     """
-    remap: Dict[int, int] = {}
+    bit_map: dict = {}
     nxt = 0
-    for g in groups:
-        for v in sorted(g):
-            if v not in remap:
-                remap[v] = nxt
-                nxt += 1
-    canon: List[Tuple[int, ...]] = []
-    for g in groups:
-        canon.append(tuple(sorted(remap[v] for v in g)))
+    pending = 0  # 尚未分配新标号的旧位
+    for m in masks:
+        pending |= m
+    for m in masks:
+        for v in _bits(m & pending):
+            bit_map[v] = 1 << nxt
+            nxt += 1
+        pending &= ~m
+        if not pending:
+            # 所有位都已分配，后续组不可能再产生新标号，提前结束
+            break
+    canon: List[int] = []
+    for m in masks:
+        r = 0
+        for v in _bits(m):
+            r |= bit_map[v]
+        canon.append(r)
     return canon
 
+@lru_cache(maxsize=1 << 18)
+def _canonical_from_masks(masks: Tuple[int, ...]) -> int:
+    """
+    规范键核心：输入为已排序的位掩码元组（可哈希，作为缓存键）。
+    条目数随可达状态数增长，缓存设上限以免大 n 时无界占用内存。
+    """
+    # 预扫描顺序（决定紧致映射的先后）：相同的组不会引入新标号，
+    # 只需按 (-组大小, 组内容字典序) 遍历互不相同的组，重复组直接查表
+    union = 0
+    for m in masks:
+        union |= m
+    sort_key = _sort_key_table(union.bit_length()).__getitem__
+    distinct = sorted(set(masks), key=sort_key)
+    # 紧致重标号
+    relabeled = dict(zip(distinct, _relabel_compact(distinct)))
+    canon = [relabeled[m] for m in masks]
+    # 最终输出顺序（重标号后的掩码不会更宽，沿用同一张表）
+    canon.sort(key=sort_key)
+    # 打包：重标号后共 width 个 secret，第 i 组占 [i*width, (i+1)*width) 位
+    width = union.bit_count()
+    key = 0
+    for m in reversed(canon):
+        key = (key << width) | m
+    return key
+
+@lru_cache(maxsize=None)
+def _initial_key(n: int) -> int:
+    """初始态 ({0},{1},...,{n-1}) 的打包键：第 i 组为 1<<i，位于第 i*n 位起。"""
+    key = 0
+    for i in range(n):
+        key |= 1 << (i * n + i)
+    return key
+
 # ---------- public ----------
-def canonical_key(secret_sets: Iterable[Iterable[Any]]) -> Tuple[Tuple[int, ...], ...]:
+def canonical_key(secret_sets: Iterable[Any]) -> int:
     """
     稳定、通用的规范键：
-      1) 允许 int / 单字符 str；
+      1) 组内元素允许 int / 单字符 str，组本身也可以直接是位掩码 int；
+         内部每组用一个整数位掩码表示；
       2) 预扫描按 (-组大小, 组内容字典序) 排序；
       3) 用预扫描顺序进行紧致重标号；
-      4) 最终按 (-组大小, 组内容字典序) 输出 (tuple of tuples)。
-    示例：[{0,1},{2}] 与 [{'A','B'},{'C'}] -> ((0,1),(2,))
+      4) 最终按 (-组大小, 组内容字典序) 排列，打包成单个 int
+         （第 i 组占第 [i*n, (i+1)*n) 位，n 为 secret 总数）。
+    结果只取决于各组的多重集合，故以排序后的掩码元组为键做记忆化，
+    BFS 中重复出现的状态直接命中缓存。
+    示例：[{0,1},{2}]、[{'A','B'},{'C'}] 与 (0b011, 0b100) -> 0b100_011，
+          unpack_key(..., 3) -> ((0,1),(2,))
+    前提：每组非空（否则空组不占位，[{0}, set()] 与 [{0}] 同键），违反时 AssertionError；
+    且只有 secret 总数 n 相同的输入之间键才唯一——位宽 n 不编码在键里，
+    如 [{0,1,2},{0,1,2}] (n=3) 与 [{0,1,2,3},{0,1}] (n=4) 同为 63。
+    gossip 中每个 agent 至少知道自己的 secret，同一次 BFS 内两条都成立；
+    unpack_key 需由调用方给出同一个 n。
     """
-    groups = _normalize_groups(secret_sets)
-    # 预扫描顺序（决定紧致映射的先后）
-    groups.sort(key=lambda g: (-len(g), tuple(sorted(g))))
-    # 紧致重标号
-    canon = _relabel_compact(groups)
-    # 最终输出顺序
-    canon.sort(key=lambda t: (-len(t), t))
-    return tuple(canon)
+    masks = _normalize_groups(secret_sets)
+    if not masks:
+        return 0
+    masks.sort()
+    assert masks[0], "canonical_key: empty group"
+    # 特例直接给出结果（BFS 首层/末层大量出现）：
+    # 所有组相同（含 n<=1 与全员知晓全部 secret 的终态）：每组重标号为 k 个低位全 1
+    if masks[0] == masks[-1]:
+        return (1 << (masks[0].bit_count() * len(masks))) - 1
+    # 初始态：各组为互不相同的单元素集合
+    total = sum(masks)
+    if total.bit_count() == len(masks) and all(m & (m - 1) == 0 for m in masks):
+        return _initial_key(len(masks))
+    return _canonical_from_masks(tuple(masks))
+
+@lru_cache(maxsize=1 << 17)
+def _canonical_key_hashable(secret_sets: Tuple[Any, ...]) -> int:
+    return canonical_key(secret_sets)
+
+def canonical_key_cached(secret_sets: Iterable[Any]) -> int:
+    """
+    canonical_key 的记忆化版本：以整个 secrets 元组为缓存键，
+    同一 worker 内重复到达的分布只做一次元组哈希 + 查表。
+    Distribution.secrets（位掩码元组）可直接命中；不可哈希的输入先转成 tuple of frozenset。
+    命中率见 canonical_key_cached.cache_info()。
+    """
+    try:
+        return _canonical_key_hashable(secret_sets)
+    except TypeError:
+        return _canonical_key_hashable(
+            tuple(g if isinstance(g, int) else frozenset(g) for g in secret_sets))
+
+canonical_key_cached.cache_info = _canonical_key_hashable.cache_info  # type: ignore[attr-defined]
+canonical_key_cached.cache_clear = _canonical_key_hashable.cache_clear  # type: ignore[attr-defined]
+
+def unpack_key(key: int, n: int) -> Tuple[Tuple[int, ...], ...]:
+    """
+    把 canonical_key 打包的 int 还原为 tuple of tuples（每组组内升序）。
+    n 为 secret 总数（gossip 中即 agent 数）；空组排在最后，不会被还原。
+    """
+    full = (1 << n) - 1
+    rows = []
+    while key:
+        rows.append(_bits(key & full))
+        key >>= n
+    return tuple(rows)
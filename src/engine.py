@@ -1,14 +1,17 @@
 # src/engine.py
 from __future__ import annotations
 
-from collections import deque
+from array import array
+from collections import Counter, defaultdict
 from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 from typing import Dict, Set, Tuple, List, Iterable, Optional
+import os
 import time
 
 from .model import Distribution, ProtocolState
-from .protocols import permitted_calls
-from .canonical import canonical_key
+from .protocols import EXPAND, permitted_calls
+from .canonical import canonical_key, canonical_key_cached, unpack_key
 
 # --------- 能力探测：是否可由 canonical key 重建状态（启用 keys-only 模式） ---------
 _HAS_DIST_FROM_CANONICAL = hasattr(Distribution, "from_canonical")
@@ -18,18 +21,19 @@ _HAS_PS_INITIAL         = hasattr(ProtocolState, "initial")
 
 _KEYS_MODE_AVAILABLE = (_HAS_DIST_FROM_CANONICAL or _HAS_DIST_FROM_SECRETS) and (_HAS_PS_FROM_DIST or _HAS_PS_INITIAL)
 
-def _build_state_from_key(key, protocol: str) -> ProtocolState:
+def _build_state_from_key(key: int, protocol: str, n: int) -> ProtocolState:
     """
     尝试用 (Distribution.from_canonical | from_secrets) + (ProtocolState.from_distribution | initial)
-    从 canonical key 重建 ProtocolState。
+    从 canonical key（打包 int，先按 n 解包）重建 ProtocolState。
     """
+    rows = unpack_key(key, n)
     # 构建 Distribution
     if _HAS_DIST_FROM_CANONICAL:
-        dist = Distribution.from_canonical(key)  # type: ignore[attr-defined]
+        dist = Distribution.from_canonical(rows)  # type: ignore[attr-defined]
     elif _HAS_DIST_FROM_SECRETS:
         # 兼容不同命名：from_secrets / from_key
         ctor = getattr(Distribution, "from_secrets", None) or getattr(Distribution, "from_key", None)
-        dist = ctor(key)
+        dist = ctor(rows)
     else:
         raise RuntimeError("keys-only mode unavailable: Distribution lacks from_canonical/from_secrets")
 
@@ -43,23 +47,97 @@ def _build_state_from_key(key, protocol: str) -> ProtocolState:
         raise RuntimeError("keys-only mode unavailable: ProtocolState lacks from_distribution/initial")
 
 
+# ---------- 前沿 keys 的定长二进制编码（共享内存传输用） ----------
+def _key_stride(n: int) -> int:
+    """每个打包 key 占用的字节数：n*n 位；不超过 64 位时统一按 uint64 存放。"""
+    nbytes = (n * n + 7) // 8
+    return 8 if nbytes <= 8 else nbytes
+
+
+def _encode_keys(keys: List[int], stride: int) -> bytes:
+    if stride == 8:
+        return array("Q", keys).tobytes()
+    return b"".join(k.to_bytes(stride, "little") for k in keys)
+
+
+def _decode_keys(buf, stride: int) -> List[int]:
+    if stride == 8:
+        return memoryview(buf).cast("Q").tolist()
+    return [int.from_bytes(buf[i:i + stride], "little") for i in range(0, len(buf), stride)]
+
+
+# 子进程内已映射的共享内存块（每层一个；换层时关闭旧块）
+_SHM_ATTACHED: Dict[str, shared_memory.SharedMemory] = {}
+
+
+def _read_shared_keys(name: str, start: int, end: int, n: int) -> List[int]:
+    """从父进程写好的共享内存块读取前沿 keys[start:end]。"""
+    shm = _SHM_ATTACHED.get(name)
+    if shm is None:
+        for old in _SHM_ATTACHED.values():
+            old.close()
+        _SHM_ATTACHED.clear()
+        shm = shared_memory.SharedMemory(name=name)
+        _SHM_ATTACHED[name] = shm
+    stride = _key_stride(n)
+    return _decode_keys(shm.buf[start * stride:end * stride], stride)
+
+
+# ---------- 子进程初始化：预热缓存 ----------
+def _worker_init(protocol: str, n: int) -> None:
+    """
+    进程池 initializer：canonical_key 等 lru_cache 是每个进程各一份，
+    先用初始状态及其一步后继预热，避免每个 worker 第一批任务冷启动。
+    """
+    st = ProtocolState.initial(Distribution.initial(n), protocol)
+    canonical_key_cached(st.distribution.secrets)
+    for call in permitted_calls(st, protocol):
+        canonical_key_cached(st.update(call, protocol).distribution.secrets)
+
+
+def _canonical_cache_stats(_=None) -> Tuple[int, int, int]:
+    """(pid, hits, misses)：供 verbose 模式汇总各 worker 的 canonical_key_cached 命中率。"""
+    info = canonical_key_cached.cache_info()
+    return os.getpid(), info.hits, info.misses
+
+
+# ---------- 后继 key 探测：先算 key，去重通过后才物化新状态 ----------
+def _probe_key(state: ProtocolState, call) -> int:
+    """
+    不构造新的 ProtocolState/Distribution，直接由父状态的 secrets 与 call 求后继的 canonical key。
+    key 只取决于 secrets 分布（与 tokens/called_pairs 无关），故无需 protocol。
+    """
+    ia, ib = call
+    secrets = list(state.distribution.secrets)
+    united = secrets[ia] | secrets[ib]
+    secrets[ia] = united
+    secrets[ib] = united
+    return canonical_key_cached(tuple(secrets))
+
+
 # ---------- 子进程任务：展开一批（支持两种模式：'states' 或 'keys'） ----------
 def _expand_batch(arg):
     """
     参数:
-      arg = (mode, payload, protocol)
-        - mode: 'states' | 'keys'
-        - payload: List[ProtocolState] 或 List[CanonicalKey]
+      arg = (mode, payload, protocol, n)
+        - mode: 'states' | 'keys' | 'shm'
+        - payload: List[ProtocolState] 或 List[CanonicalKey]（打包 int）；
+          'shm' 模式为 (共享内存名, start, end)，keys 由子进程直接从共享内存读取
         - protocol: str
+        - n: agent 数（keys 模式解包 canonical key 用）
     返回:
       (out_keys, out_states_or_none)
-        - keys: 去重后的 canonical keys 列表
+        - keys: 去重后的 canonical keys；mode='states' 时为列表，
+          mode='keys'/'shm' 时为 _encode_keys 的定长字节串（回传少走 pickle）
         - states_or_none: 若 mode='states'，返回与 keys 一一对应的 ProtocolState 列表；若 mode='keys'，返回 None
     去重策略:
       - 对每个父状态做本地去重 (local_seen)
       - 对整个批次做一次去重 (batch_seen)
     """
-    mode, payload, protocol = arg
+    mode, payload, protocol, n = arg
+    if mode == "shm":
+        payload = _read_shared_keys(*payload, n)
+        mode = "keys"
     batch_seen = set()
 
     out_keys: List = []
@@ -67,20 +145,21 @@ def _expand_batch(arg):
     out_states: Optional[List[ProtocolState]] = [] if mode == "states" else None
 
     if mode == "states":
+        expand = EXPAND[protocol]
         states: List[ProtocolState] = payload
         for st in states:
             local_seen = set()
             local_pairs = []
-            for call in permitted_calls(st, protocol):
-                ns = st.update(call, protocol)
-                k = canonical_key(ns.distribution.secrets)
+            agents = st.distribution.agents
+            for secrets, tokens, pairs in expand(st):
+                k = canonical_key_cached(secrets)
                 if k in local_seen:
                     continue
                 local_seen.add(k)
                 if k in batch_seen:
                     continue
                 batch_seen.add(k)
-                local_pairs.append((k, ns))
+                local_pairs.append((k, ProtocolState(Distribution(agents, secrets), tokens, pairs)))
             if local_pairs:
                 ks, sts = zip(*local_pairs)
                 out_keys.extend(ks)
@@ -89,11 +168,11 @@ def _expand_batch(arg):
     elif mode == "keys":
         keys: List = payload
         for k0 in keys:
-            st = _build_state_from_key(k0, protocol)
+            st = _build_state_from_key(k0, protocol, n)
             local_seen = set()
             for call in permitted_calls(st, protocol):
-                ns = st.update(call, protocol)
-                k = canonical_key(ns.distribution.secrets)
+                # keys-only 模式只回传 key，后继状态无需物化
+                k = _probe_key(st, call)
                 if k in local_seen:
                     continue
                 local_seen.add(k)
@@ -101,13 +180,44 @@ def _expand_batch(arg):
                     continue
                 batch_seen.add(k)
                 out_keys.append(k)
-        # keys-only 模式下不回传 states
+        # keys-only 模式下不回传 states；keys 打包成定长字节串回传
+        return _encode_keys(out_keys, _key_stride(n)), None
     else:
         raise ValueError(f"Unknown mode: {mode}")
 
     return out_keys, out_states
 
 
+def _bfs_result(depth_of: Dict[int, int], keep_layers: bool, transitions: int) -> dict:
+    """
+    统一的 BFS 返回结构：depth_of 为 key -> 首次到达深度（即 seen）。
+    layer_sizes 由深度计数得到；layers 仅在 keep_layers=True 时按深度一次性重建。
+    """
+    res = {
+        "reachable_count": len(depth_of),
+        "layer_sizes": dict(Counter(depth_of.values())),
+        "transitions": transitions,
+    }
+    if keep_layers:
+        layers: Dict[int, Set[int]] = defaultdict(set)
+        for k, d in depth_of.items():
+            layers[d].add(k)
+        res["layers"] = dict(layers)
+    return res
+
+
+# 自适应批大小的上限（单批 payload 的内存预算）
+_AUTO_BATCH_MAX = 8192
+
+
+def _auto_batch_size(frontier_len: int, workers: int, cap: int = _AUTO_BATCH_MAX) -> int:
+    """
+    按当前层前沿大小选择批大小：每个 worker 约 4 批。
+    大前沿用大批摊薄 IPC 开销，小前沿退化到 1 以保持所有 worker 忙碌。
+    """
+    return max(1, min(cap, frontier_len // (workers * 4)))
+
+
 def chunked(seq: list, size: int) -> Iterable[list]:
     for i in range(0, len(seq), size):
         yield seq[i:i + size]
@@ -123,47 +233,50 @@ class ReachabilityEngine:
         self._use_keys_mode = bool(_KEYS_MODE_AVAILABLE)
 
     # ----------------------------- 串行 BFS -----------------------------
-    def bfs(self, n: int, max_depth: int = 10):
+    def bfs(self, n: int, max_depth: int = 10, keep_layers: bool = True):
+        """
+        keep_layers=False 时只统计每层数量（layer_sizes），不保留各层 key 集合，
+        返回结果中也不含 "layers"。
+        """
         start_dist = Distribution.initial(n)
         root_state = ProtocolState.initial(start_dist, self.protocol)
 
         start_key = canonical_key(start_dist.secrets)
-        seen: Set[Tuple[Tuple[int, ...], ...]] = {start_key}
-        layers: Dict[int, Set[Tuple[Tuple[int, ...], ...]]] = {0: {start_key}}
-        queue = deque([(root_state, 0)])
+        # key -> 首次到达深度：兼作 seen，各层数量/各层 key 在返回时由它导出
+        depth_of: Dict[int, int] = {start_key: 0}
+        frontier: List[ProtocolState] = [root_state]
         transitions = 0
 
         if max_depth == 0:
-            return {
-                "reachable_count": len(seen),
-                "layers": layers,
-                "layer_sizes": {d: len(s) for d, s in layers.items()},
-                "transitions": 0,
-            }
-
-        while queue:
-            state, depth = queue.popleft()
-            if depth == max_depth:
-                continue
-            local_seen = set()
-            for call in permitted_calls(state, self.protocol):
-                new_state = state.update(call, self.protocol)
-                key = canonical_key(new_state.distribution.secrets)
-                if key in local_seen:
-                    continue
-                local_seen.add(key)
-                transitions += 1
-                if key not in seen:
-                    seen.add(key)
-                    queue.append((new_state, depth + 1))
-                    layers.setdefault(depth + 1, set()).add(key)
-
-        return {
-            "reachable_count": len(seen),
-            "layers": layers,
-            "layer_sizes": {d: len(s) for d, s in layers.items()},
-            "transitions": transitions,
-        }
+            return _bfs_result(depth_of, keep_layers, 0)
+
+        # 按协议一次分派融合的展开函数；热循环里用局部名（LOAD_FAST），避免每条边的全局/属性查找
+        expand = EXPAND[self.protocol]
+        local_canon = canonical_key_cached
+        agents = start_dist.agents
+
+        # 分层同步：逐层展开整张前沿列表，层内顺序与 FIFO 队列一致，
+        # 队列里不再携带 depth，也不用逐个检查 depth == max_depth
+        for depth in range(max_depth):
+            if not frontier:
+                break
+            next_frontier: List[ProtocolState] = []
+            push = next_frontier.append
+            for state in frontier:
+                local_seen = set()
+                for secrets, tokens, pairs in expand(state):
+                    key = local_canon(secrets)
+                    if key in local_seen:
+                        continue
+                    local_seen.add(key)
+                    transitions += 1
+                    if key not in depth_of:
+                        depth_of[key] = depth + 1
+                        # 确认是新状态后才包装成 ProtocolState
+                        push(ProtocolState(Distribution(agents, secrets), tokens, pairs))
+            frontier = next_frontier
+
+        return _bfs_result(depth_of, keep_layers, transitions)
 
     # ------------------------ 分层并行 BFS（支持 keys-only / states 双模式） ------------------------
     def bfs_parallel(
@@ -174,9 +287,13 @@ class ReachabilityEngine:
         batch_size: int = 2048,   # 稍大默认，降低调度/IPC；可被命令行覆盖
         verbose: bool = True,
         heartbeat_every: int = 10,  # 每处理多少批打印一次心跳
+        keep_layers: bool = True,   # False: 只统计 layer_sizes，不保留各层 key
+        auto_batch: bool = False,   # True: 每层按前沿大小自适应批大小（忽略 batch_size）
+        shared_frontier: bool = True,  # keys-only 模式下经共享内存下发前沿，任务只传 (名, start, end)
     ):
         """
-        Level-parallel BFS with a persistent ProcessPoolExecutor.
+        Level-parallel BFS with a persistent ProcessPoolExecutor；
+        各批结果按提交顺序合并，固定 (n, max_depth, workers, batch_size) 下结果可复现。
         Windows: 从脚本调用（if __name__ == '__main__':）。
         """
         start_dist = Distribution.initial(n)
@@ -192,8 +309,7 @@ class ReachabilityEngine:
             root = ProtocolState.initial(start_dist, self.protocol)
             frontier_states = [root]
 
-        seen: Set[Tuple[Tuple[int, ...], ...]] = {start_key}
-        layers: Dict[int, Set[Tuple[Tuple[int, ...], ...]]] = {0: {start_key}}
+        depth_of: Dict[int, int] = {start_key: 0}
         transitions = 0
 
         if verbose:
@@ -201,16 +317,19 @@ class ReachabilityEngine:
             print(f"[engine] parallel mode = {mode_name}", flush=True)
 
         if max_depth == 0:
-            return {
-                "reachable_count": len(seen),
-                "layers": layers,
-                "layer_sizes": {d: len(s) for d, s in layers.items()},
-                "transitions": 0,
-            }
+            return _bfs_result(depth_of, keep_layers, 0)
 
         workers = max(1, int(workers))
 
-        with ProcessPoolExecutor(max_workers=workers) as ex:
+        # 不支持展开的协议（如 ATK）在父进程直接报错，不必等 initializer 在子进程里失败
+        if self.protocol not in EXPAND:
+            raise KeyError(self.protocol)
+
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_worker_init,
+            initargs=(self.protocol, n),
+        ) as ex:
             for depth in range(max_depth):
                 # 选择当前前沿视图
                 if self._use_keys_mode:
@@ -221,19 +340,31 @@ class ReachabilityEngine:
                 if frontier_len == 0:
                     break
 
+                bs = _auto_batch_size(frontier_len, workers) if auto_batch else batch_size
+
                 if verbose:
-                    print(f"[depth {depth}] frontier={frontier_len}  seen={len(seen)}",
+                    print(f"[depth {depth}] frontier={frontier_len}  seen={len(depth_of)}  batch={bs}",
                           flush=True)
 
                 t0 = time.perf_counter()
 
                 # 构造批次（keys 或 states）
-                if self._use_keys_mode:
-                    batches = [frontier_keys[i:i + batch_size] for i in range(0, frontier_len, batch_size)]  # type: ignore[index]
-                    args_list = [("keys", b, self.protocol) for b in batches]
+                shm: Optional[shared_memory.SharedMemory] = None
+                stride = _key_stride(n)
+                if self._use_keys_mode and shared_frontier:
+                    # 整层前沿一次写入共享内存，每个任务只携带 (名, start, end)
+                    shm = shared_memory.SharedMemory(create=True, size=frontier_len * stride)
+                    shm.buf[:frontier_len * stride] = _encode_keys(frontier_keys, stride)  # type: ignore[arg-type]
+                    args_list = [
+                        ("shm", (shm.name, i, min(i + bs, frontier_len)), self.protocol, n)
+                        for i in range(0, frontier_len, bs)
+                    ]
+                elif self._use_keys_mode:
+                    batches = [frontier_keys[i:i + bs] for i in range(0, frontier_len, bs)]  # type: ignore[index]
+                    args_list = [("keys", b, self.protocol, n) for b in batches]
                 else:
-                    batches = [frontier_states[i:i + batch_size] for i in range(0, frontier_len, batch_size)]  # type: ignore[index]
-                    args_list = [("states", b, self.protocol) for b in batches]
+                    batches = [frontier_states[i:i + bs] for i in range(0, frontier_len, bs)]  # type: ignore[index]
+                    args_list = [("states", b, self.protocol, n) for b in batches]
 
                 cs = max(1, len(args_list) // (workers * 4)) if args_list else 1
                 total_batches = len(args_list)
@@ -242,41 +373,50 @@ class ReachabilityEngine:
                 next_frontier_states: Optional[List[ProtocolState]] = [] if not self._use_keys_mode else None
                 next_frontier_keys: Optional[List] = [] if self._use_keys_mode else None
 
-                for i, (keys, states_or_none) in enumerate(
-                    ex.map(_expand_batch, args_list, chunksize=cs), start=1
-                ):
-                    transitions += len(keys)
-                    if self._use_keys_mode:
-                        for k in keys:
-                            if k not in seen:
-                                seen.add(k)
-                                next_frontier_keys.append(k)  # type: ignore[union-attr]
-                                layers.setdefault(depth + 1, set()).add(k)
-                    else:
-                        # states 模式：keys 与 states 一一对应
-                        sts = states_or_none or []
-                        for k, st in zip(keys, sts):
-                            if k not in seen:
-                                seen.add(k)
-                                next_frontier_states.append(st)  # type: ignore[union-attr]
-                                layers.setdefault(depth + 1, set()).add(k)
-
-                    if verbose and (i % heartbeat_every == 0 or i == total_batches):
-                        print(f"    processed {i}/{total_batches} batches", flush=True)
+                try:
+                    for i, (keys, states_or_none) in enumerate(
+                        ex.map(_expand_batch, args_list, chunksize=cs), start=1
+                    ):
+                        if self._use_keys_mode:
+                            keys = _decode_keys(keys, stride)
+                        transitions += len(keys)
+                        if self._use_keys_mode:
+                            for k in keys:
+                                if k not in depth_of:
+                                    depth_of[k] = depth + 1
+                                    next_frontier_keys.append(k)  # type: ignore[union-attr]
+                        else:
+                            # states 模式：keys 与 states 一一对应
+                            sts = states_or_none or []
+                            for k, st in zip(keys, sts):
+                                if k not in depth_of:
+                                    depth_of[k] = depth + 1
+                                    next_frontier_states.append(st)  # type: ignore[union-attr]
+
+                        if verbose and (i % heartbeat_every == 0 or i == total_batches):
+                            print(f"    processed {i}/{total_batches} batches", flush=True)
+                finally:
+                    if shm is not None:
+                        shm.close()
+                        shm.unlink()
 
                 # 切换到下一层前沿
                 frontier_keys = next_frontier_keys if self._use_keys_mode else None
                 frontier_states = next_frontier_states if not self._use_keys_mode else None
+                new_len = len(frontier_keys or frontier_states or [])
 
                 if verbose:
                     t1 = time.perf_counter()
-                    new_len = len(frontier_keys or frontier_states or [])
-                    print(f"  -> new={new_len}  seen={len(seen)}  elapsed={t1 - t0:.2f}s",
+                    print(f"  -> new={new_len}  seen={len(depth_of)}  elapsed={t1 - t0:.2f}s",
                           flush=True)
 
-        return {
-            "reachable_count": len(seen),
-            "layers": layers,
-            "layer_sizes": {d: len(s) for d, s in layers.items()},
-            "transitions": transitions,
-        }
+            if verbose:
+                # 每个 worker 各自一份缓存：撒一轮探针任务，按 pid 去重后汇总（可能漏掉个别 worker）
+                stats = {pid: (h, m) for pid, h, m in ex.map(_canonical_cache_stats, range(workers * 4))}
+                hits = sum(h for h, _ in stats.values())
+                misses = sum(m for _, m in stats.values())
+                rate = hits / (hits + misses) if hits + misses else 0.0
+                print(f"[engine] canonical_key cache: hits={hits}  misses={misses}  "
+                      f"hit_rate={rate:.1%}  ({len(stats)}/{workers} workers)", flush=True)
+
+        return _bfs_result(depth_of, keep_layers, transitions)
@@ -5,6 +5,7 @@ from .engine import ReachabilityEngine
 
 def _run(protocol: str, n: int, max_depth: int = 10, parallel: bool = False, **kwargs):
     eng = ReachabilityEngine(protocol)
+    # 这里只用到计数，不保留各层 key 集合
     if parallel:
         return eng.bfs_parallel(
             n,
@@ -12,9 +13,10 @@ def _run(protocol: str, n: int, max_depth: int = 10, parallel: bool = False, **k
             workers=kwargs.get("workers", 4),
             batch_size=kwargs.get("batch_size", 256),
             verbose=kwargs.get("verbose", False),
+            keep_layers=False,
         )
     else:
-        return eng.bfs(n, max_depth=max_depth)
+        return eng.bfs(n, max_depth=max_depth, keep_layers=False)
 
 def count_reachable(protocol: str, n: int, max_depth: int = 10, parallel: bool = False, **kwargs) -> int:
     """返回可达等价类总数（含深度0）。"""
@@ -23,9 +25,9 @@ def count_reachable(protocol: str, n: int, max_depth: int = 10, parallel: bool =
 def per_level_counts(protocol: str, n: int, max_depth: int = 10, parallel: bool = False, **kwargs) -> List[int]:
     """返回每一层的状态数（从0层开始的连续列表）。"""
     res = _run(protocol, n, max_depth, parallel, **kwargs)
-    layers = res.get("layers", {})
-    if not layers:
+    sizes = res.get("layer_sizes", {})
+    if not sizes:
         return [0]
-    dmax = max(layers.keys())
-    return [len(layers.get(d, set())) for d in range(0, dmax + 1)]
+    dmax = max(sizes.keys())
+    return [sizes.get(d, 0) for d in range(0, dmax + 1)]
 
@@ -6,7 +6,7 @@ Collection of analysis helpers:
 """
 
 from statistics import mean
-from statistics import stdev
+import math
 from typing import List, Dict
 import random
 
@@ -18,9 +18,9 @@ def avg_branching(transitions: int, visited: int) -> float:
 
 # ---------- NEW: Monte‑Carlo simulation ----------
 from .engine import ReachabilityEngine
-from .protocols import permitted_calls
+from .protocols import ALLOW, permitted_calls
 from .model import Distribution, ProtocolState
-from tqdm import trange    
+from tqdm import tqdm
 
 
 
@@ -31,23 +31,132 @@ def random_run(protocol: str, n: int, max_steps: int = 1000) -> int:
     """
     dist = Distribution.initial(n)
     state = ProtocolState.initial(dist, protocol)
+    pred = ALLOW[protocol]
+    randrange = random.randrange
+    max_tries = n * n
 
     for step in range(max_steps):
         if state.distribution.is_final():
             return step
-        calls = permitted_calls(state, protocol)
-        if not calls:                 # dead end (should not occur for ANY/TOK)
-            return step
-        state = state.update(random.choice(calls), protocol)
+        # 拒绝采样：均匀抽有序对 (a, b)，谓词通过即用，省去每步构造整张 permitted_calls 列表
+        call = None
+        for _ in range(max_tries):
+            a, b = randrange(n), randrange(n)
+            if a != b and pred(state, (a, b)):
+                call = (a, b)
+                break
+        if call is None:
+            # 连续 n^2 次被拒：退回完整列表（同样均匀），并借此识别死局
+            calls = permitted_calls(state, protocol)
+            if not calls:             # dead end (should not occur for ANY/TOK)
+                return step
+            call = random.choice(calls)
+        state = state.update(call, protocol)
     return max_steps
 
 
-def expected_length(protocol: str, n: int, runs: int = 10_000):
+def _random_runs_numpy(np, protocol: str, n: int, runs: int, max_steps: int = 1000):
+    """
+    random_run 的批量版本：runs 条轨迹同步推进，每行一个状态
+    （secrets 位掩码 (runs, n)、tokens 位掩码 (runs,)、已呼叫对 (runs, n, n) 布尔矩阵）。
+    每轮对所有未结束的行各抽一个有序对，谓词通过的行执行呼叫，其余行重抽；
+    连续 n^2 次被拒的行退回到在全部可行呼叫中均匀挑一个（无可行呼叫即死局结束）。
+    返回每条轨迹的呼叫次数 (runs,) 数组。
+    """
+    rng = np.random.default_rng(42)                   # 保证可复现
+    full = (1 << n) - 1
+    S = np.tile(np.left_shift(1, np.arange(n, dtype=np.int64)), (runs, 1))
+    tokens = np.full(runs, full if protocol in {"TOK", "SPI"} else 0, dtype=np.int64)
+    called = np.zeros((runs, n, n), dtype=bool) if protocol in {"CO", "LNS"} else None
+    steps = np.zeros(runs, dtype=np.int64)
+    rejects = np.zeros(runs, dtype=np.int64)
+    done = (S == full).all(axis=1)
+
+    def allowed(rows, a, b):
+        if protocol == "ANY":
+            return np.ones(len(rows), dtype=bool)
+        if protocol in {"TOK", "SPI"}:
+            return (tokens[rows] >> a) & 1 == 1
+        ok = ~called[rows, a, b]
+        if protocol == "LNS":
+            ok &= (S[rows, b] & ~S[rows, a]) != 0
+        return ok
+
+    def apply(rows, a, b):
+        u = S[rows, a] | S[rows, b]
+        S[rows, a] = u
+        S[rows, b] = u
+        if protocol == "TOK":
+            # caller将自己全部token交给callee（合并）
+            tokens[rows] = (tokens[rows] & ~(1 << a)) | (1 << b)
+        elif protocol == "SPI":
+            # callee永久失去token
+            tokens[rows] &= ~(1 << b)
+        if called is not None:
+            called[rows, a, b] = True
+            called[rows, b, a] = True
+        steps[rows] += 1
+        rejects[rows] = 0
+        done[rows] = (S[rows] == full).all(axis=1) | (steps[rows] >= max_steps)
+
+    while True:
+        rows = np.flatnonzero(~done)
+        if rows.size == 0:
+            break
+        a = rng.integers(0, n, size=rows.size)
+        b = rng.integers(0, n - 1, size=rows.size)
+        b += b >= a                                   # 均匀的有序对 (a, b)，a != b
+        ok = allowed(rows, a, b)
+        apply(rows[ok], a[ok], b[ok])
+        rejects[rows[~ok]] += 1
+
+        stuck = rows[~ok][rejects[rows[~ok]] >= n * n]
+        if stuck.size:
+            # 对卡住的行枚举全部有序对，在可行呼叫中均匀挑一个
+            aa, bb = np.nonzero(~np.eye(n, dtype=bool))
+            mask = np.stack([allowed(stuck, np.full(stuck.size, i), np.full(stuck.size, j))
+                             for i, j in zip(aa, bb)], axis=1)
+            dead = ~mask.any(axis=1)
+            done[stuck[dead]] = True                  # dead end (should not occur for ANY/TOK)
+            live = stuck[~dead]
+            if live.size:
+                pick = np.argmax(rng.random(mask[~dead].shape) * mask[~dead], axis=1)
+                apply(live, aa[pick], bb[pick])
+    return steps
+
+
+def expected_length(protocol: str, n: int, runs: int = 10_000, vectorized: bool = True):
+    """
+    Monte-Carlo 期望呼叫次数 (mean, sample stdev)。
+    vectorized=True 且 NumPy 可用时，所有轨迹用数组批量同步模拟；否则逐条调用 random_run。
+    注意：默认的批量路径使用 np.random.default_rng(42) 的随机流，且没有进度条；
+    以前按 random.seed(42) 记录的基准数值不再能逐位复现（vectorized=False 走 random 模块，
+    但 random_run 已改为拒绝采样，抽样序列同样变了），只在统计意义上一致。
+    """
+    if vectorized and 1 < n < 63 and protocol in ALLOW:
+        try:
+            import numpy as np  # type: ignore
+        except Exception as e:
+            print(f"[warn] NumPy not available ({e}); fall back to per-run simulation.")
+        else:
+            lengths = _random_runs_numpy(np, protocol, n, runs)
+            return float(lengths.mean()), float(lengths.std(ddof=1))
+
     random.seed(42)                                   # 保证可复现
-    lengths = [random_run(protocol, n)
-               for _ in trange(runs, desc=f"{protocol}{n}")]
-    mu = sum(lengths) / runs
-    sigma = stdev(lengths)
+    # Welford 单遍累计均值与二阶中心矩：不保存 lengths 列表
+    # 进度条只按约 1% 的粒度手动推进，热循环里不再逐次 tick tqdm
+    mu, m2 = 0.0, 0.0
+    tick = max(1, runs // 100)
+    with tqdm(total=runs, desc=f"{protocol}{n}") as bar:
+        for i in range(runs):
+            x = random_run(protocol, n)
+            delta = x - mu
+            mu += delta / (i + 1)
+            m2 += delta * (x - mu)
+            if (i + 1) % tick == 0:
+                bar.update(tick)
+        bar.update(runs - bar.n)
+    sigma = math.sqrt(m2 / (runs - 1)) if runs > 1 else float("nan")
     return mu, sigma
 
 
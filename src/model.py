@@ -1,81 +1,87 @@
 from __future__ import annotations
 from dataclasses import dataclass
-from typing import FrozenSet, Tuple, List
+from typing import Tuple, List
 
 Agent = str
-Secret = str
-Call = Tuple[Agent, Agent]  # (caller, callee)
+SecretMask = int            # bit i = 第 i 个 agent 的 secret（agent 'a' -> 'A' -> bit 0）
+Call = Tuple[int, int]      # (caller, callee)，均为 agents 中的下标
 
 
 @dataclass(frozen=True)
 class Distribution:
-    agents: Tuple[Agent, ...]                # fixed order
-    secrets: Tuple[FrozenSet[Secret], ...]   # aligned with agents
+    agents: Tuple[Agent, ...]           # fixed order
+    secrets: Tuple[SecretMask, ...]     # aligned with agents；每个 agent 已知 secret 的位掩码
 
     # ---------- basic ops ----------
     def apply_call(self, call: Call) -> "Distribution":
-        a, b = call
-        ia, ib = self.agents.index(a), self.agents.index(b)
-        sa, sb = self.secrets[ia], self.secrets[ib]
-        united = sa | sb
+        ia, ib = call
+        united = self.secrets[ia] | self.secrets[ib]
         secrets_new = list(self.secrets)
         secrets_new[ia] = united
         secrets_new[ib] = united
         return Distribution(self.agents, tuple(secrets_new))
 
     def is_final(self) -> bool:
-        all_s = set().union(*self.secrets)
-        return all(all_s == s for s in self.secrets)
+        secrets = self.secrets
+        full = (1 << len(secrets)) - 1
+        # tuple.count 在 C 层逐个比较，省去生成器与 all() 的逐项开销
+        return secrets.count(full) == len(secrets)
 
-    # canonical handled in canonical.py; here keep simple tuple
+    # canonical handled in canonical.py；位掩码元组本身即可哈希
     def to_tuple(self):
-        return tuple(tuple(sorted(s)) for s in self.secrets)
+        return self.secrets
 
     @staticmethod
     def initial(n: int) -> "Distribution":
         agents = tuple(chr(ord("a") + i) for i in range(n))
-        secrets = tuple(frozenset({ag.upper()}) for ag in agents)
+        secrets = tuple(1 << i for i in range(n))
         return Distribution(agents, secrets)
 
 
+def pair_bit(a: int, b: int) -> int:
+    """无序对 {a, b}（a != b）在 called_pairs 位掩码中的位：hi*(hi-1)/2 + lo，与 n 无关。"""
+    if a > b:
+        a, b = b, a
+    return 1 << (b * (b - 1) // 2 + a)
+
+
+# 需要记录已呼叫对的协议（其余协议的 called_pairs 恒为 0）
+_PAIR_PROTOCOLS = frozenset({"CO", "LNS"})
+
+
 @dataclass(frozen=True)
 class ProtocolState:
     distribution: Distribution
-    tokens: FrozenSet[Agent]             # for TOK/SPI
-    called_pairs: FrozenSet[frozenset]   # CO 已呼叫过的无序对
+    tokens: int         # for TOK/SPI；bit i = agent i 持有 token
+    called_pairs: int   # CO/LNS 已呼叫过的无序对，bit 见 pair_bit；其余协议恒为 0
 
     def update(self, call: Call, protocol: str) -> "ProtocolState":
         a, b = call
         dist2 = self.distribution.apply_call(call)
-        tokens = set(self.tokens)
+        # 只更新本协议会读取的字段，其余原样沿用（均为 int，无需复制）
+        tokens = self.tokens
+        pairs = self.called_pairs
 
         if protocol == "TOK":
             # caller将自己全部token交给callee（合并）
-            if a in tokens:
-                tokens.remove(a)
-                tokens.add(b)
+            if tokens >> a & 1:
+                tokens = (tokens & ~(1 << a)) | (1 << b)
         elif protocol == "SPI":
             # callee永久失去token
-            tokens.discard(b)
-
-        new_pairs = set(self.called_pairs)
-        new_pairs.add(frozenset({a, b}))
+            tokens &= ~(1 << b)
+        elif protocol in _PAIR_PROTOCOLS:
+            pairs |= pair_bit(a, b)
 
-        return ProtocolState(
-            dist2,
-            frozenset(tokens),
-            frozenset(new_pairs),
-        )
+        return ProtocolState(dist2, tokens, pairs)
 
     @staticmethod
     def initial(dist: Distribution, protocol: str) -> "ProtocolState":
-        agents = dist.agents
-        tokens = frozenset(agents) if protocol in {"TOK", "SPI"} else frozenset()
-        return ProtocolState(dist, tokens, frozenset())
+        tokens = (1 << len(dist.agents)) - 1 if protocol in {"TOK", "SPI"} else 0
+        return ProtocolState(dist, tokens, 0)
 
 # === Keys-only 工厂方法 · 兼容补丁（覆盖版） =======================================
 # 目的：让 engine 的 keys-only 模式可用，并确保 Distribution.secrets 的内部
-#       元素是 set/frozenset（而不是 tuple），以支持 `|` 等集合运算。
+#       元素与 initial() 一致（位掩码 int，或旧式 set/frozenset），以支持 `|` 运算。
 
 from typing import Any, Iterable, Tuple, Type
 
@@ -110,7 +116,7 @@ def _infer_n_from_key(key: Tuple[Tuple[int, ...], ...]) -> int:
 
 def _detect_inner_set_type(cls) -> Type:
     """
-    尝试从 Distribution.initial(1).secrets 的内部元素类型推断使用 set 还是 frozenset；
+    尝试从 Distribution.initial(1).secrets 的内部元素类型推断使用 int 位掩码、set 还是 frozenset；
     若无法判断，默认用 set。
     """
     try:
@@ -118,6 +124,8 @@ def _detect_inner_set_type(cls) -> Type:
         secrets = getattr(probe, "secrets", None)
         if secrets and len(secrets) > 0:
             inner = next(iter(secrets))
+            if isinstance(inner, int):
+                return int
             if isinstance(inner, frozenset):
                 return frozenset
             if isinstance(inner, set):
@@ -129,9 +137,17 @@ def _detect_inner_set_type(cls) -> Type:
 def _coerce_groups_to_sets(key_can: Tuple[Tuple[int, ...], ...], inner_type: Type):
     """
     将 canonical key 转换为 Distribution 内部使用的集合容器。
-    inner_type: set 或 frozenset
-    返回同构容器（例如 tuple[set[int]] 或 tuple[frozenset[int]]）
+    inner_type: int（位掩码）、set 或 frozenset
+    返回同构容器（例如 tuple[int]、tuple[set[int]] 或 tuple[frozenset[int]]）
     """
+    if inner_type is int:
+        masks = []
+        for row in key_can:
+            m = 0
+            for v in row:
+                m |= 1 << v
+            masks.append(m)
+        return tuple(masks)
     if inner_type is frozenset:
         return tuple(frozenset(row) for row in key_can)
     else:
@@ -220,7 +236,9 @@ def _ps_from_distribution(cls, dist, protocol: str):
     再不行尝试 ctor(dist=..., protocol=...) / ctor(dist, protocol)。
     """
     existing = getattr(cls, "from_distribution", None)
-    if existing and existing is not _ps_from_distribution and callable(existing):
+    # 安装后 cls.from_distribution 是绑定到本函数的 classmethod，需比较 __func__，
+    # 否则会自我递归直到 RecursionError 才退回 initial（每次重建约千层调用）
+    if existing and getattr(existing, "__func__", existing) is not _ps_from_distribution and callable(existing):
         try:
             return existing(dist, protocol)
         except Exception:
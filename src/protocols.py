@@ -1,13 +1,13 @@
 from __future__ import annotations
-from typing import List, Iterable, Tuple
-from .model import ProtocolState, Call
+from functools import lru_cache
+from typing import Iterator, List, Tuple
+from .model import ProtocolState, Call, pair_bit
 
 
-def _all_calls(agents: Tuple[str, ...]) -> Iterable[Call]:
-    for a in agents:
-        for b in agents:
-            if a != b:
-                yield (a, b)
+@lru_cache(maxsize=None)
+def _all_calls(n: int) -> Tuple[Call, ...]:
+    # n 个 agent 的 n*(n-1) 个有序呼叫（下标对）只枚举一次，之后复用同一批 tuple
+    return tuple((a, b) for a in range(n) for b in range(n) if a != b)
 
 
 # ---------- per‑protocol permission ----------
@@ -16,29 +16,27 @@ def allow_ANY(state: ProtocolState, call: Call) -> bool:
 
 
 def allow_CO(state: ProtocolState, call: Call) -> bool:
-    return frozenset(call) not in state.called_pairs
+    return not state.called_pairs & pair_bit(*call)
 
 
 def allow_LNS(state: ProtocolState, call: Call) -> bool:
     a, b = call
 
-    if frozenset({a, b}) in state.called_pairs:
+    if state.called_pairs & pair_bit(a, b):
         return False
     
-    dist = state.distribution
-    sa = dist.secrets[dist.agents.index(a)]
-    sb = dist.secrets[dist.agents.index(b)]
-    return not sb.issubset(sa)
+    secrets = state.distribution.secrets
+    return secrets[b] & ~secrets[a] != 0
 
 
 def allow_TOK(state: ProtocolState, call: Call) -> bool:
     a, _ = call
-    return a in state.tokens
+    return state.tokens >> a & 1 == 1
 
 
 def allow_SPI(state: ProtocolState, call: Call) -> bool:
     a, _ = call
-    return a in state.tokens
+    return state.tokens >> a & 1 == 1
 
 
 ALLOW = {
@@ -51,5 +49,79 @@ ALLOW = {
 
 
 def permitted_calls(state: ProtocolState, protocol: str) -> List[Call]:
+    calls = _all_calls(len(state.distribution.agents))
+    if protocol == "ANY":
+        return list(calls)
     pred = ALLOW[protocol]
-    return [c for c in _all_calls(state.distribution.agents) if pred(state, c)]
+    return [c for c in calls if pred(state, c)]
+
+
+# ---------- 融合的后继展开：谓词 + 状态转移一次完成 ----------
+# 每个 expand_X(state) 按 permitted_calls 的顺序产出 (secrets, tokens, called_pairs)，
+# 不构造 ProtocolState/Distribution，由调用方在确认是新状态后再包装。
+@lru_cache(maxsize=None)
+def _call_table(n: int) -> Tuple[Tuple[int, int, int], ...]:
+    """(caller, callee, pair_bit) 三元组，顺序同 _all_calls(n)。"""
+    return tuple((a, b, pair_bit(a, b)) for a, b in _all_calls(n))
+
+
+def expand_ANY(state: ProtocolState) -> Iterator[Tuple[Tuple[int, ...], int, int]]:
+    secrets, tokens, pairs = state.distribution.secrets, state.tokens, state.called_pairs
+    for a, b in _all_calls(len(secrets)):
+        s = list(secrets)
+        s[a] = s[b] = secrets[a] | secrets[b]
+        yield tuple(s), tokens, pairs
+
+
+def expand_CO(state: ProtocolState) -> Iterator[Tuple[Tuple[int, ...], int, int]]:
+    secrets, tokens, pairs = state.distribution.secrets, state.tokens, state.called_pairs
+    for a, b, pb in _call_table(len(secrets)):
+        if pairs & pb:
+            continue
+        s = list(secrets)
+        s[a] = s[b] = secrets[a] | secrets[b]
+        yield tuple(s), tokens, pairs | pb
+
+
+def expand_LNS(state: ProtocolState) -> Iterator[Tuple[Tuple[int, ...], int, int]]:
+    secrets, tokens, pairs = state.distribution.secrets, state.tokens, state.called_pairs
+    for a, b, pb in _call_table(len(secrets)):
+        if pairs & pb:
+            continue
+        sa, sb = secrets[a], secrets[b]
+        if not sb & ~sa:
+            continue
+        s = list(secrets)
+        s[a] = s[b] = sa | sb
+        yield tuple(s), tokens, pairs | pb
+
+
+def expand_TOK(state: ProtocolState) -> Iterator[Tuple[Tuple[int, ...], int, int]]:
+    secrets, tokens, pairs = state.distribution.secrets, state.tokens, state.called_pairs
+    for a, b in _all_calls(len(secrets)):
+        if not tokens >> a & 1:
+            continue
+        s = list(secrets)
+        s[a] = s[b] = secrets[a] | secrets[b]
+        # caller将自己全部token交给callee（合并）
+        yield tuple(s), (tokens & ~(1 << a)) | (1 << b), pairs
+
+
+def expand_SPI(state: ProtocolState) -> Iterator[Tuple[Tuple[int, ...], int, int]]:
+    secrets, tokens, pairs = state.distribution.secrets, state.tokens, state.called_pairs
+    for a, b in _all_calls(len(secrets)):
+        if not tokens >> a & 1:
+            continue
+        s = list(secrets)
+        s[a] = s[b] = secrets[a] | secrets[b]
+        # callee永久失去token
+        yield tuple(s), tokens & ~(1 << b), pairs
+
+
+EXPAND = {
+    "ANY": expand_ANY,
+    "CO": expand_CO,
+    "LNS": expand_LNS,
+    "TOK": expand_TOK,
+    "SPI": expand_SPI,
+}
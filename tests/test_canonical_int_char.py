@@ -1,6 +1,21 @@
-from src.canonical import canonical_key
+import pytest
+
+from src.canonical import canonical_key, canonical_key_cached, unpack_key
 
 def test_canonical_accepts_int_and_char():
     k1 = canonical_key([{0,1},{2}])
     k2 = canonical_key([{'A','B'},{'C'}])
-    assert k1 == k2 == ((0,1),(2,))
+    assert k1 == k2
+    assert canonical_key((0b011, 0b100)) == k1  # 组直接给位掩码
+    assert unpack_key(k1, 3) == ((0,1),(2,))
+
+def test_canonical_key_cached_matches():
+    secrets = (frozenset('AB'), frozenset('AB'), frozenset('C'))
+    assert canonical_key_cached(secrets) == canonical_key(secrets)
+    # 不可哈希的输入（list of set）也可用
+    assert canonical_key_cached([{0,1},{0,1},{2}]) == canonical_key(secrets)
+
+def test_canonical_rejects_empty_group():
+    # 空组不占位，会与去掉空组的输入撞键
+    with pytest.raises(AssertionError):
+        canonical_key([{0}, set()])
@@ -0,0 +1,15 @@
+import math
+
+import pytest
+
+from src.metrics import expected_length
+
+@pytest.mark.parametrize("protocol", ["ANY", "LNS"])
+def test_vectorized_matches_scalar(protocol):
+    pytest.importorskip("numpy")
+    runs = 400
+    mu_v, sd_v = expected_length(protocol, 4, runs=runs)
+    mu_s, sd_s = expected_length(protocol, 4, runs=runs, vectorized=False)
+    # 两条路径随机流不同，只要求均值差在约 4 个标准误以内
+    se = math.sqrt((sd_v ** 2 + sd_s ** 2) / runs)
+    assert abs(mu_v - mu_s) <= 4 * se
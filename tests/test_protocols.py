@@ -1,5 +1,7 @@
+import pytest
+
 from src.model import Distribution, ProtocolState
-from src.protocols import permitted_calls
+from src.protocols import EXPAND, permitted_calls
 
 def make_state(protocol: str, n=3):
     d = Distribution.initial(n)
@@ -18,3 +20,23 @@ def test_lns_initial():
     st = make_state("LNS")
     # 初始时所有 caller 都能学到新 secret，仍是全对有向
     assert len(permitted_calls(st, "LNS")) == 6
+
+def _walk(protocol: str, n: int, steps: int):
+    """从初始状态沿第一条/最后一条可行呼叫交替走若干步，产出途经的（含非初始）状态。"""
+    st = make_state(protocol, n)
+    yield st
+    for i in range(steps):
+        calls = permitted_calls(st, protocol)
+        if not calls:
+            return
+        st = st.update(calls[0] if i % 2 == 0 else calls[-1], protocol)
+        yield st
+
+@pytest.mark.parametrize("protocol", ["ANY", "CO", "LNS", "TOK", "SPI"])
+def test_expand_matches_update(protocol):
+    # 融合展开 EXPAND 必须与 permitted_calls + ProtocolState.update 逐条一致（含顺序）
+    for n in (3, 4):
+        for st in _walk(protocol, n, 4):
+            expected = [(s.distribution.secrets, s.tokens, s.called_pairs)
+                        for s in (st.update(c, protocol) for c in permitted_calls(st, protocol))]
+            assert list(EXPAND[protocol](st)) == expected